@@ -1,9 +1,12 @@
 import os
 from distutils.util import strtobool
 
+import requests
 import supervisely as sly
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from supervisely.io.fs import mkdir
+from urllib3.util.retry import Retry
 
 if sly.is_development():
     load_dotenv("local.env")
@@ -35,6 +38,45 @@ project_classes = {
     "point_cloud_episodes": sly.PointcloudEpisodeProject,
 }
 
+# connect and server errors are retried a few times here, resume loops in main.py
+# count an attempt only after these retries are exhausted
+dropbox_retry = Retry(
+    total=3,
+    backoff_factor=1,
+    status_forcelist=[500, 502, 503, 504],
+    allowed_methods=frozenset(["GET", "HEAD"]),
+    respect_retry_after_header=True,
+)
+# archives are already compressed, so the server should not compress them again
+dropbox_headers = {
+    "Accept-Encoding": "identity",
+    "Connection": "keep-alive",
+    "User-Agent": f"restore-archived-project requests/{requests.__version__}",
+}
+dropbox_session = requests.Session()
+dropbox_session.mount(
+    "https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=dropbox_retry)
+)
+dropbox_session.headers.update(dropbox_headers)
+# range support probe is not retried, download falls back to a single stream on failure
+dropbox_probe_session = requests.Session()
+dropbox_probe_session.mount("https://", HTTPAdapter(max_retries=Retry(0)))
+dropbox_probe_session.headers.update(dropbox_headers)
+
+max_io_workers = min(32, (os.cpu_count() or 1) * 4)
+# cpu_count reports host cores in containers, affinity follows cpuset limits
+if hasattr(os, "sched_getaffinity"):
+    available_cpus = len(os.sched_getaffinity(0))
+else:
+    available_cpus = os.cpu_count() or 1
+max_process_workers = max(1, min(8, available_cpus))
+# smaller zip archives are extracted in one process, starting a pool costs more
+zip_parallel_min_size = 100 * 1024 * 1024
+# larger archive members are written from stream instead of being read into memory
+max_buffered_member_size = 8 * 1024 * 1024
+# parsed annotation tags are reused for identical tag json, up to this many
+tags_cache_size = 4096
+
 download_mode = bool(strtobool(os.environ.get("modal.state.downloadMode", "false")))
 
 troubleshooting_link = (
@@ -1,29 +1,56 @@
+import bz2
+import errno
+import gzip
+import io
 import json
+import lzma
+import mmap
+import multiprocessing
 import os
-import re
 import shutil
+import subprocess
 import tarfile
+import tempfile
+import threading
 import time
 import zipfile
-from typing import List
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import BinaryIO, Callable, FrozenSet, List, Optional, Tuple
 
-import magic
 import requests
 import supervisely as sly
+import urllib3
 from supervisely.api.module_api import ApiField
 from supervisely.io.fs import (
-    archive_directory,
     dir_empty,
-    file_exists,
     get_file_name,
     get_subdirs,
-    list_dir_recursively,
 )
 from supervisely.io.json import load_json_file
 from tqdm import tqdm
 
 import globals as g
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# multithreaded decompressors in order of preference
+DECOMPRESS_COMMANDS = {
+    "gzip": [["pigz", "-dc"]],
+    "bzip2": [["lbzip2", "-dc"], ["pbzip2", "-dc"]],
+    "xz": [["xz", "-T0", "-dc"]],
+    "zstd": [["zstd", "-T0", "-dc"]],
+}
+
 
 class NotEnoughDiskSpaceError(Exception):
     """
@@ -34,6 +61,15 @@ class NotEnoughDiskSpaceError(Exception):
         super().__init__(message)
 
 
+class RangeNotSupportedError(Exception):
+    """
+    Server ignored range request and sent the whole file
+    """
+
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
 def raise_exception_with_troubleshooting_link(error: Exception) -> None:
     """
     Raise exception with troubleshooting link
@@ -47,64 +83,90 @@ def raise_exception_with_troubleshooting_link(error: Exception) -> None:
     raise error
 
 
-def download_file_from_dropbox(shared_link: str, destination_path: str, ent_type: str) -> None:
+def wait_before_resume(retry_attemp: int, error: Exception, max_retries: int = 8) -> None:
     """
-    Download file from DropBox with progress bar
+    Wait before resuming interrupted download.
+    Connection errors and server errors before response are retried by g.dropbox_session,
+    this handles connections dropped in the middle of the response.
 
-    :param shared_link: shared link to file
+    :param retry_attemp: number of current retry attempt
+    :param error: exception that interrupted download
+    :param max_retries: number of retries before error is raised
+    """
+
+    if retry_attemp > max_retries:
+        raise_exception_with_troubleshooting_link(error)
+    sly.logger.warning(
+        f"Downloading request error, please wait ... Retrying ({retry_attemp}/{max_retries})"
+    )
+    time.sleep(5 if retry_attemp <= max_retries // 2 else 10)
+
+
+def download_single_stream(direct_link: str, destination_path: str, ent_type: str) -> None:
+    """
+    Download file from DropBox over a single connection with progress bar
+
+    :param direct_link: direct link to file
     :param destination_path: path to save file
     :param ent_type: type of archive
     """
 
-    direct_link = shared_link.replace("dl=0", "dl=1")
-    sly.logger.info(f"Start downloading backuped {ent_type} from DropBox")
-
     retry_attemp = 0
     timeout = 10
 
     total_size = None
+    # number of bytes already reported to progress bar
+    reported = 0
 
     while True:
         try:
-            with open(destination_path, "ab") as file:
-                response = requests.get(
-                    direct_link,
-                    stream=True,
-                    headers={"Range": f"bytes={file.tell()}-"},
-                    timeout=timeout,
-                )
+            with open(destination_path, "ab", buffering=1 << 20) as file, g.dropbox_session.get(
+                direct_link,
+                stream=True,
+                headers={"Range": f"bytes={file.tell()}-"},
+                timeout=timeout,
+            ) as response:
+                start = file.tell()
                 content_type = response.headers.get("content-type")
-                available_content_types = ["application/binary", "application/zip", "application/x-tar"]
+                available_content_types = [
+                    "application/binary",
+                    "application/zip",
+                    "application/x-tar",
+                ]
                 if response.status_code != 206 and content_type not in available_content_types:
                     msg = f"Status code: {response.status_code}, content type: {content_type}."
                     sly.logger.warning(msg)
                     raise requests.exceptions.RequestException(msg)
+                if response.status_code != 206 and start > 0:
+                    # server ignored range and sends the whole file again
+                    sly.logger.warning("Download can not be resumed, starting from the beginning")
+                    file.truncate(0)
+                    start = 0
+                content_length = int(response.headers.get("content-length", 0))
                 if total_size is None:
-                    total_size = int(response.headers.get("content-length", 0))
+                    total_size = content_length
                     progress_bar = tqdm(
                         desc=f"Downloading backuped {ent_type} from DropBox",
                         total=total_size,
                         is_size=True,
                     )
                 sly.logger.debug("Connection established")
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
+                writer = ProgressFileWriter(file, progress_bar, max(0, reported - start))
+                response.raw.decode_content = True
+                try:
+                    shutil.copyfileobj(response.raw, writer, length=1 << 20)
+                finally:
+                    reported = max(reported, start + writer.written)
+                    if writer.written > 0:
                         retry_attemp = 0
-                        file.write(chunk)
-                        progress_bar.update(len(chunk))
-        except requests.exceptions.RequestException as e:
+                if content_length and writer.written < content_length:
+                    raise requests.exceptions.RequestException(
+                        "Connection closed before file was received"
+                    )
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
             retry_attemp += 1
-            if timeout < 90:
-                timeout += 10
-            if retry_attemp == 9:
-                raise_exception_with_troubleshooting_link(e)
-            sly.logger.warning(
-                f"Downloading request error, please wait ... Retrying ({retry_attemp}/8)"
-            )
-            if retry_attemp <= 4:
-                time.sleep(5)
-            elif 4 < retry_attemp < 9:
-                time.sleep(10)
+            timeout = min(timeout + 10, 90)
+            wait_before_resume(retry_attemp, e)
         except Exception as e:
             retry_attemp += 1
             if retry_attemp == 3:
@@ -116,21 +178,355 @@ def download_file_from_dropbox(shared_link: str, destination_path: str, ent_type
             break
 
 
-def download_backup(project_info: sly.ProjectInfo):
+class ProgressFileWriter:
+    """
+    File wrapper which updates progress bar with number of written bytes.
+    First skip_progress bytes are not reported, they were reported by previous attempt.
+    """
+
+    def __init__(self, file: BinaryIO, progress_bar: tqdm, skip_progress: int = 0):
+        self.file = file
+        self.progress_bar = progress_bar
+        self.skip_progress = skip_progress
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        size = self.file.write(data)
+        self.written += size
+        progress = min(size, self.written - self.skip_progress)
+        if progress > 0:
+            self.progress_bar.update(progress)
+        return size
+
+
+def get_content_length(direct_link: str) -> Optional[int]:
+    """
+    Get size of file if server supports range requests for it
+
+    :param direct_link: direct link to file
+    :return: size of file in bytes or None if range requests are not supported
+    """
+
+    try:
+        response = g.dropbox_probe_session.head(direct_link, allow_redirects=True, timeout=10)
+        total_size = int(response.headers.get("content-length", 0))
+        if response.headers.get("accept-ranges") == "bytes" and total_size > 0:
+            return total_size
+        with g.dropbox_probe_session.get(
+            direct_link, stream=True, headers={"Range": "bytes=0-0"}, timeout=10
+        ) as response:
+            content_range = response.headers.get("content-range", "")
+            if response.status_code == 206 and "/" in content_range:
+                total_size = content_range.rsplit("/", 1)[-1]
+                if total_size.isdigit():
+                    return int(total_size)
+    except requests.exceptions.RequestException as e:
+        sly.logger.debug(f"Failed to probe range support: {repr(e)}")
+    return None
+
+
+def download_range(
+    direct_link: str,
+    fd: int,
+    start: int,
+    end: int,
+    progress_cb: Callable[[int], None],
+    chunk_size: int,
+    stop_event: threading.Event,
+) -> None:
+    """
+    Download byte range of file into its offset of the destination file
+
+    :param direct_link: direct link to file
+    :param fd: file descriptor of destination file
+    :param start: first byte of range
+    :param end: last byte of range (inclusive)
+    :param progress_cb: callback to report number of downloaded bytes
+    :param chunk_size: size of chunk to read from response
+    :param stop_event: event which is set when download of another range failed
+    """
+
+    offset = start
+    retry_attemp = 0
+    timeout = 10
+
+    while offset <= end and not stop_event.is_set():
+        try:
+            with g.dropbox_session.get(
+                direct_link,
+                stream=True,
+                headers={"Range": f"bytes={offset}-{end}"},
+                timeout=timeout,
+            ) as response:
+                if response.status_code == 200:
+                    raise RangeNotSupportedError(
+                        f"Server sent the whole file for range {offset}-{end}"
+                    )
+                if response.status_code != 206:
+                    msg = f"Status code: {response.status_code} for range {offset}-{end}."
+                    sly.logger.warning(msg)
+                    raise requests.exceptions.RequestException(msg)
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if stop_event.is_set():
+                        return
+                    if chunk:
+                        retry_attemp = 0
+                        view = memoryview(chunk)
+                        while view:
+                            written = os.pwrite(fd, view, offset)
+                            offset += written
+                            view = view[written:]
+                        progress_cb(len(chunk))
+            if offset <= end:
+                raise requests.exceptions.RequestException(
+                    f"Connection closed before range {start}-{end} was received"
+                )
+        except requests.exceptions.RequestException as e:
+            retry_attemp += 1
+            timeout = min(timeout + 10, 90)
+            wait_before_resume(retry_attemp, e)
+
+
+def download_ranges(
+    direct_link: str,
+    destination_path: str,
+    total_size: int,
+    ent_type: str,
+    num_conns: int = 8,
+    chunk_size: int = 1 << 20,
+) -> None:
+    """
+    Download file from DropBox with several parallel range requests
+
+    :param direct_link: direct link to file
+    :param destination_path: path to save file
+    :param total_size: size of file in bytes
+    :param ent_type: type of archive
+    :param num_conns: number of parallel connections
+    :param chunk_size: size of chunk to read from response
+    """
+
+    part_size = -(-total_size // num_conns)
+    ranges = [
+        (start, min(start + part_size, total_size) - 1)
+        for start in range(0, total_size, part_size)
+    ]
+
+    fd = os.open(destination_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, total_size)
+        except (AttributeError, OSError) as e:
+            sly.logger.debug(f"Failed to preallocate file: {repr(e)}")
+
+        lock = threading.Lock()
+        with tqdm(
+            desc=f"Downloading backuped {ent_type} from DropBox",
+            total=total_size,
+            is_size=True,
+        ) as progress_bar:
+
+            def _update_progress(n: int) -> None:
+                with lock:
+                    progress_bar.update(n)
+
+            stop_event = threading.Event()
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(
+                        download_range,
+                        direct_link,
+                        fd,
+                        start,
+                        end,
+                        _update_progress,
+                        chunk_size,
+                        stop_event,
+                    )
+                    for start, end in ranges
+                ]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # stop other ranges instead of waiting until they are downloaded
+                    stop_event.set()
+                    for future in futures:
+                        future.cancel()
+                    raise
+    finally:
+        os.close(fd)
+    sly.logger.debug(f"{ent_type.capitalize()} downloaded successfully")
+
+
+def download_file_from_dropbox(shared_link: str, destination_path: str, ent_type: str) -> None:
+    """
+    Download file from DropBox with progress bar.
+    Uses parallel range requests if server supports them, otherwise a single stream.
+
+    :param shared_link: shared link to file
+    :param destination_path: path to save file
+    :param ent_type: type of archive
+    """
+
+    direct_link = shared_link.replace("dl=0", "dl=1")
+    sly.logger.info(f"Start downloading backuped {ent_type} from DropBox")
+
+    total_size = get_content_length(direct_link)
+    if total_size is None:
+        sly.logger.debug("Range requests are not supported, downloading in a single stream")
+        download_single_stream(direct_link, destination_path, ent_type)
+    else:
+        try:
+            download_ranges(direct_link, destination_path, total_size, ent_type)
+        except RangeNotSupportedError as e:
+            sly.logger.warning(f"{e}, downloading in a single stream")
+            os.remove(destination_path)
+            download_single_stream(direct_link, destination_path, ent_type)
+
+
+class ResumableDownloadStream(io.RawIOBase):
+    """
+    Readable stream of file from DropBox.
+    Download is resumed with Range request on connection errors.
     """
-    Download backup from DropBox
 
-    :param project_info: sly.ProjectInfo
+    def __init__(self, direct_link: str, chunk_size: int = 1 << 20):
+        super().__init__()
+        self.direct_link = direct_link
+        self.chunk_size = chunk_size
+        self.position = 0
+        self.total_size = None
+        self._response = None
+        self._chunks = None
+        self._chunk = memoryview(b"")
+        self._retry_attemp = 0
+        self._timeout = 10
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        self._close_response()
+        super().close()
+
+    def _close_response(self) -> None:
+        self._chunks = None
+        if self._response is not None:
+            self._response.close()
+            self._response = None
+
+    def _connect(self) -> None:
+        self._close_response()
+        response = self._response = g.dropbox_session.get(
+            self.direct_link,
+            stream=True,
+            headers={"Range": f"bytes={self.position}-"},
+            timeout=self._timeout,
+        )
+        content_type = response.headers.get("content-type")
+        available_content_types = ["application/binary", "application/zip", "application/x-tar"]
+        if response.status_code != 206 and (
+            self.position > 0 or content_type not in available_content_types
+        ):
+            msg = f"Status code: {response.status_code}, content type: {content_type}."
+            sly.logger.warning(msg)
+            raise requests.exceptions.RequestException(msg)
+        if self.total_size is None:
+            self.total_size = int(response.headers.get("content-length", 0)) or None
+        sly.logger.debug("Connection established")
+        self._chunks = response.iter_content(chunk_size=self.chunk_size)
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk:
+            try:
+                if self._chunks is None:
+                    self._connect()
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    self._close_response()
+                    if self.total_size is None or self.position >= self.total_size:
+                        return 0
+                    raise requests.exceptions.RequestException(
+                        "Connection closed before file was received"
+                    )
+                self._chunk = memoryview(chunk)
+                self._retry_attemp = 0
+            except requests.exceptions.RequestException as e:
+                self._close_response()
+                self._retry_attemp += 1
+                self._timeout = min(self._timeout + 10, 90)
+                wait_before_resume(self._retry_attemp, e)
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        self.position += size
+        return size
+
+
+def stream_download_and_extract(shared_link: str, extract_path: str, ent_type: str) -> bool:
     """
+    Extract tar archive from DropBox while it is being downloaded
 
-    files_archive_url = project_info.backup_archive.get(ApiField.URL)
-    annotations_archive_url = project_info.backup_archive.get(ApiField.ANN_URL)
+    :param shared_link: shared link to archive
+    :param extract_path: path to extract directory
+    :param ent_type: type of archive
+    :return: True if archive was extracted, False if it is not a tar archive
+    """
+
+    direct_link = shared_link.replace("dl=0", "dl=1")
+    sly.logger.info(f"Start downloading and extracting backuped {ent_type} from DropBox")
+
+    raw_stream = ResumableDownloadStream(direct_link)
+    with io.BufferedReader(raw_stream, buffer_size=1 << 20) as stream:
+        try:
+            file_type = get_buffer_type(stream.peek(512)[:512])
+        except ValueError as e:
+            file_type = None
+            sly.logger.debug(f"Archive can not be streamed: {repr(e)}")
+        if file_type != "tar":
+            # closes the streamed response before the archive is downloaded again
+            stream.close()
+            return False
+
+        if raw_stream.total_size is not None and not has_free_space(
+            raw_stream.total_size, extract_path
+        ):
+            raise_exception_with_troubleshooting_link(
+                NotEnoughDiskSpaceError("Not enough disk space")
+            )
 
-    if files_archive_url:
-        download_file_from_dropbox(files_archive_url, g.archive_files_path, "files")
+        message = f"Extracting {ent_type}"
+        try:
+            with tarfile.open(fileobj=stream, mode="r|", bufsize=1 << 20) as tar_ref, tqdm(
+                total=raw_stream.total_size, is_size=True, desc=message
+            ) as progress_bar:
+                with ParallelFileWriter(progress_bar) as writer:
+                    tar_parts = extract_tar_members(tar_ref, extract_path, writer)
+        except Exception as e:
+            raise_exception_with_troubleshooting_link(e)
+    sly.logger.debug(f"{ent_type.capitalize()} downloaded and extracted successfully")
+    extract_tar_parts(tar_parts, extract_path)
+    return True
 
-    if annotations_archive_url:
-        download_file_from_dropbox(annotations_archive_url, g.archive_ann_path, "annotations")
+
+def restore_backup_archive(
+    shared_link: str, archive_path: str, extract_path: str, ent_type: str
+) -> None:
+    """
+    Download backup archive from DropBox and extract it.
+    Tar archives are extracted while downloading, other archives are downloaded first.
+
+    :param shared_link: shared link to archive
+    :param archive_path: path to save archive if it can not be streamed
+    :param extract_path: path to extract directory
+    :param ent_type: type of archive
+    """
+
+    if not stream_download_and_extract(shared_link, extract_path, ent_type):
+        download_file_from_dropbox(shared_link, archive_path, ent_type)
+        unzip_archive(archive_path, extract_path)
 
 
 def is_tar_part(filename: str) -> bool:
@@ -141,27 +537,62 @@ def is_tar_part(filename: str) -> bool:
     :return: True if file is a part of tar archive, False otherwise
     """
 
-    split_tar_pattern = r".+\.(tar\.\d{3})$"
-    return bool(re.match(split_tar_pattern, filename))
+    # same as matching r".+\.tar\.\d{3}$", without running a regex for every file
+    return len(filename) > 8 and filename[-8:-3] == ".tar." and filename[-3:].isdecimal()
 
 
-def get_tar_parts(directory: str) -> List[str]:
+def is_extracted_tar_part(extract_dir: str, member_path: str) -> bool:
     """
-    Get list of tar parts in directory
+    Check if extracted archive member is a tar part in root of extract directory
 
-    :param directory: path to directory
-    :return: list of tar parts
+    :param extract_dir: absolute path to extract directory
+    :param member_path: path to extracted member
+    :return: True if member is a tar part, False otherwise
     """
 
-    tar_parts = []
-    for filename in os.listdir(directory):
-        full_path = os.path.join(directory, filename)
-        if os.path.isfile(full_path) and is_tar_part(filename):
-            tar_parts.append(full_path)
-    return tar_parts
+    directory, filename = os.path.split(member_path)
+    return is_tar_part(filename) and directory == extract_dir
+
+
+class ConcatenatedFilesReader:
+    """
+    Readable stream of several files following each other
+    """
+
+    def __init__(self, paths: List[str]):
+        self._paths = list(paths)
+        self._index = 0
+        self._file = None
+
+    def __enter__(self) -> "ConcatenatedFilesReader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while size != 0 and self._index < len(self._paths):
+            if self._file is None:
+                self._file = open(self._paths[self._index], "rb")
+            chunk = self._file.read(size)
+            if not chunk:
+                self._file.close()
+                self._file = None
+                self._index += 1
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
 
-def combine_parts(parts_paths: str, output_path: str) -> str:
+def combine_parts(parts_paths: List[str], output_path: str) -> str:
     """
     Combine parts of tar archive
 
@@ -175,83 +606,647 @@ def combine_parts(parts_paths: str, output_path: str) -> str:
     with open(output_path, "wb") as output_file:
         for part_path in parts_paths:
             with open(part_path, "rb") as part_file:
-                data = part_file.read()
-                output_file.write(data)
+                append_file(part_file, output_file)
             os.remove(part_path)
     return output_path
 
 
+def append_file(source_file: io.BufferedReader, output_file: io.BufferedWriter) -> None:
+    """
+    Append content of source file to output file without loading it into memory.
+    Uses os.copy_file_range or os.sendfile if it is available, memory mapping otherwise.
+
+    :param source_file: file opened for reading
+    :param output_file: file opened for writing
+    """
+
+    output_file.flush()
+    source_fd = source_file.fileno()
+    output_fd = output_file.fileno()
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(source_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    size = os.fstat(source_fd).st_size
+    # every method continues from the offset the previous one stopped at,
+    # some filesystems make kernel copy functions return 0 before the end of file
+    offset = 0
+    # copy_file_range can share extents on filesystems with reflink support
+    if hasattr(os, "copy_file_range"):
+        start = offset
+        try:
+            while offset < size:
+                copied = os.copy_file_range(source_fd, output_fd, size - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as e:
+            if offset != start:
+                raise
+            sly.logger.debug(f"os.copy_file_range is not supported: {repr(e)}")
+        if offset == size:
+            return
+    if hasattr(os, "sendfile"):
+        start = offset
+        try:
+            while offset < size:
+                sent = os.sendfile(output_fd, source_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if offset != start:
+                raise
+            sly.logger.debug(f"os.sendfile is not supported: {repr(e)}")
+        if offset == size:
+            return
+    try:
+        mapped = mmap.mmap(source_fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        sly.logger.debug(f"mmap is not supported: {repr(e)}")
+        source_file.seek(offset)
+        shutil.copyfileobj(source_file, output_file, length=4 * 1024 * 1024)
+        return
+    # mapped pages are written from page cache without an intermediate bytes copy
+    with mapped, memoryview(mapped) as view, view[offset:] as remaining:
+        output_file.write(remaining)
+
+
 def get_file_type(file_path: str) -> str:
     """
-    Get file type by magic library
+    Get file type by its header
 
     :param file_path: path to file
     :return: file type
     """
-    mime = magic.Magic()
-    file_type = mime.from_file(file_path)
-    if file_type.startswith("Zip archive"):
-        file_type = "zip"
-    elif file_type.startswith("POSIX tar archive"):
-        file_type = "tar"
-    else:
-        raise ValueError(f"Unsupported file type: {file_type}")
-    return file_type
+    with open(file_path, "rb") as file:
+        return get_buffer_type(file.read(512))
 
 
-def extract_tar_with_progress(archive_path: str, extract_dir: str, message: str) -> None:
+def get_buffer_type(buffer: bytes) -> str:
+    """
+    Get type of file by its first 512 bytes
+
+    :param buffer: first bytes of file
+    :return: file type
+    """
+    if buffer[:4] in (b"PK\x03\x04", b"PK\x05\x06", b"PK\x07\x08"):
+        return "zip"
+    if len(buffer) >= 265 and buffer[257:262] == b"ustar":
+        return "tar"
+    if buffer[:2] == b"\x1f\x8b":
+        return "gzip"
+    if buffer[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    if buffer[:3] == b"BZh":
+        return "bzip2"
+    if buffer[:6] == b"\xfd7zXZ\x00":
+        return "xz"
+    raise ValueError(f"Unsupported file type, file header: {buffer[:16]}")
+
+
+def get_member_path(extract_dir: str, member_name: str) -> str:
+    """
+    Get path to extract archive member to
+
+    :param extract_dir: path to extract directory
+    :param member_name: name of archive member
+    :return: path to extracted member
+    """
+
+    extract_dir = os.path.abspath(extract_dir)
+    member_path = os.path.normpath(os.path.join(extract_dir, member_name))
+    if os.path.commonpath([extract_dir, member_path]) != extract_dir:
+        raise ValueError(f"Archive member is outside of extract directory: {member_name}")
+    return member_path
+
+
+def write_file(path: str, data: bytes, mode: Optional[int] = None) -> None:
+    """
+    Write data to file
+
+    :param path: path to file
+    :param data: file content
+    :param mode: file permissions
+    """
+
+    with open(path, "wb") as file:
+        file.write(data)
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+def write_file_from_fd(
+    path: str, source_fd: int, offset: int, size: int, mode: Optional[int] = None
+) -> None:
+    """
+    Write range of another file to file.
+    Uses os.sendfile to copy data in kernel if it is available.
+
+    :param path: path to file
+    :param source_fd: file descriptor of source file
+    :param offset: offset of range in source file
+    :param size: size of range
+    :param mode: file permissions
+    """
+
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining > 0:
+            if hasattr(os, "sendfile"):
+                written = os.sendfile(file.fileno(), source_fd, offset, remaining)
+            else:
+                written = file.write(os.pread(source_fd, min(remaining, 1 << 20), offset))
+            if written == 0:
+                raise EOFError(f"Unexpected end of file while writing {path}")
+            offset += written
+            remaining -= written
+    if mode is not None:
+        os.chmod(path, mode)
+
+
+class ParallelFileWriter:
+    """
+    Write extracted files to disk in a thread pool.
+    Number and total size of files waiting to be written are bounded to limit memory usage,
+    large files are written from their stream without loading them into memory.
+    Progress of small files is reported in batches of progress_step bytes.
+    """
+
+    def __init__(
+        self,
+        progress_bar: tqdm,
+        max_pending: int = 64,
+        max_pending_size: int = 64 << 20,
+        progress_step: int = 4 << 20,
+    ):
+        self._progress_bar = progress_bar
+        self._progress_step = progress_step
+        self._pending_progress = 0
+        self._lock = threading.Lock()
+        self._semaphore = threading.Semaphore(max_pending)
+        self._max_pending_size = max_pending_size
+        # number and size of files being written, paths being written and first write error
+        self._pending_count = 0
+        self._pending_size = 0
+        self._pending_paths = {}
+        self._error = None
+        self._pending_changed = threading.Condition()
+        self._created_dirs = set()
+        self._executor = ThreadPoolExecutor(max_workers=g.max_io_workers)
+
+    def __enter__(self) -> "ParallelFileWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def make_dirs(self, dir_path: str) -> None:
+        """
+        Create directory once
+
+        :param dir_path: path to directory
+        """
+
+        if dir_path not in self._created_dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self._created_dirs.add(dir_path)
+
+    def submit(
+        self,
+        path: str,
+        data: bytes,
+        mode: Optional[int] = None,
+        progress_size: Optional[int] = None,
+    ) -> None:
+        """
+        Schedule writing data to file
+
+        :param path: path to file
+        :param data: file content
+        :param mode: file permissions
+        :param progress_size: number of bytes to add to progress bar, defaults to size of data
+        """
+
+        if progress_size is None:
+            progress_size = len(data)
+        data_size = len(data)
+        with self._pending_changed:
+            # a single file larger than the limit is still accepted when nothing is pending
+            while self._pending_size and self._pending_size + data_size > self._max_pending_size:
+                self._pending_changed.wait()
+            self._pending_size += data_size
+        self._submit(path, progress_size, data_size, write_file, path, data, mode)
+
+    def write_stream(
+        self,
+        path: str,
+        source: BinaryIO,
+        mode: Optional[int] = None,
+        progress_size: Optional[int] = None,
+    ) -> None:
+        """
+        Write file from stream in the calling thread without loading it into memory
+
+        :param path: path to file
+        :param source: file content stream
+        :param mode: file permissions
+        :param progress_size: number of bytes to add to progress bar, defaults to size of file
+        """
+
+        self._raise_error()
+        self.make_dirs(os.path.dirname(path))
+        self._wait_for_path(path)
+        with open(path, "wb") as file:
+            shutil.copyfileobj(source, file, 1 << 20)
+            written = file.tell()
+        if mode is not None:
+            os.chmod(path, mode)
+        self.update_progress(written if progress_size is None else progress_size)
+
+    def submit_from_fd(
+        self,
+        path: str,
+        source_fd: int,
+        offset: int,
+        size: int,
+        mode: Optional[int] = None,
+        progress_size: Optional[int] = None,
+    ) -> None:
+        """
+        Schedule writing range of another file to file
+
+        :param path: path to file
+        :param source_fd: file descriptor of source file
+        :param offset: offset of range in source file
+        :param size: size of range
+        :param mode: file permissions
+        :param progress_size: number of bytes to add to progress bar, defaults to size of range
+        """
+
+        if progress_size is None:
+            progress_size = size
+        self._submit(
+            path, progress_size, 0, write_file_from_fd, path, source_fd, offset, size, mode
+        )
+
+    def update_progress(self, size: int) -> None:
+        """
+        Update progress bar
+
+        :param size: number of processed bytes
+        """
+
+        with self._lock:
+            self._pending_progress += size
+            if self._pending_progress >= self._progress_step:
+                self._progress_bar.update(self._pending_progress)
+                self._pending_progress = 0
+
+    def wait(self) -> None:
+        """
+        Wait until all scheduled files are written, raise first write error
+        """
+
+        with self._pending_changed:
+            while self._pending_count:
+                self._pending_changed.wait()
+        self._raise_error()
+        with self._lock:
+            if self._pending_progress != 0:
+                self._progress_bar.update(self._pending_progress)
+                self._pending_progress = 0
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _wait_for_path(self, path: str) -> None:
+        # later archive member with the same path has to overwrite earlier one
+        with self._pending_changed:
+            while path in self._pending_paths:
+                self._pending_changed.wait()
+
+    def _submit(self, path: str, progress_size: int, data_size: int, fn: Callable, *args) -> None:
+        try:
+            self._raise_error()
+            self.make_dirs(os.path.dirname(path))
+            self._wait_for_path(path)
+        except BaseException:
+            with self._pending_changed:
+                self._pending_size -= data_size
+                self._pending_changed.notify_all()
+            raise
+        self._semaphore.acquire()
+        with self._pending_changed:
+            self._pending_count += 1
+            future = self._executor.submit(fn, *args)
+            self._pending_paths[path] = future
+        # callback is called right away if file is already written
+        future.add_done_callback(
+            partial(self._on_done, path=path, progress_size=progress_size, data_size=data_size)
+        )
+
+    def _on_done(self, future: Future, path: str, progress_size: int, data_size: int) -> None:
+        self._semaphore.release()
+        error = future.exception()
+        with self._pending_changed:
+            self._pending_count -= 1
+            self._pending_size -= data_size
+            if self._pending_paths.get(path) is future:
+                del self._pending_paths[path]
+            if error is not None and self._error is None:
+                self._error = error
+            self._pending_changed.notify_all()
+        if error is None:
+            self.update_progress(progress_size)
+
+
+def extract_tar_with_progress(archive_path: str, extract_dir: str, message: str) -> List[str]:
     """
     Extract tar archive with progress bar
 
     :param archive_path: path to tar archive
     :param extract_dir: path to extract directory
     :param message: message for progress bar
+    :return: paths to extracted tar parts
     """
 
+    total_size = os.path.getsize(archive_path)
     with tarfile.open(archive_path, "r") as tar_ref:
-        total_size = sum(file_info.size for file_info in tar_ref.getmembers())
+        # members of uncompressed archive are copied from archive file directly
+        tar_fd = None
+        if isinstance(tar_ref.fileobj, io.BufferedReader):
+            tar_fd = tar_ref.fileobj.fileno()
         with tqdm(total=total_size, is_size=True, desc=message) as progress_bar:
-            for file_info in tar_ref.getmembers():
-                tar_ref.extract(file_info, path=extract_dir)
-                progress_bar.update(file_info.size)
+            with ParallelFileWriter(progress_bar) as writer:
+                return extract_tar_members(tar_ref, extract_dir, writer, tar_fd)
 
 
-def extract_zip_with_progress(archive_path: str, extract_dir: str, message: str) -> None:
+def open_decompressor(
+    archive_path: str, file_type: str, stderr_file: BinaryIO
+) -> Tuple[BinaryIO, Optional[subprocess.Popen]]:
     """
-    Extract zip archive with progress bar
+    Open decompressed stream of archive.
+    Multithreaded decompressor is used if it is installed.
+
+    :param archive_path: path to compressed archive
+    :param file_type: type of compression, "gzip", "bzip2", "xz" or "zstd"
+    :param stderr_file: file to write errors of external decompressor to
+    :return: decompressed stream and decompressor process if external decompressor is used
+    """
+
+    if file_type not in DECOMPRESS_COMMANDS:
+        raise ValueError(f"Unsupported compression: {file_type}")
+
+    for command in DECOMPRESS_COMMANDS[file_type]:
+        if shutil.which(command[0]) is not None:
+            process = subprocess.Popen(
+                command + [archive_path],
+                stdout=subprocess.PIPE,
+                # file instead of pipe, so warnings can not fill it up and block decompressor
+                stderr=stderr_file,
+                bufsize=1 << 20,
+            )
+            return process.stdout, process
+    if file_type == "gzip":
+        return gzip.open(archive_path, "rb"), None
+    if file_type == "bzip2":
+        return bz2.open(archive_path, "rb"), None
+    if file_type == "xz":
+        return lzma.open(archive_path, "rb"), None
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(open(archive_path, "rb")), None
+    raise RuntimeError("zstd is required to extract zstd compressed archive")
+
+
+def extract_tar_members(
+    tar_ref: tarfile.TarFile,
+    extract_dir: str,
+    writer: ParallelFileWriter,
+    tar_fd: Optional[int] = None,
+) -> List[str]:
+    """
+    Extract members of tar archive in the order they are stored
+
+    :param tar_ref: tar archive
+    :param extract_dir: path to extract directory
+    :param writer: writer for regular files
+    :param tar_fd: file descriptor of uncompressed archive file to copy members from directly
+    :return: paths to extracted tar parts
+    """
+
+    abs_extract_dir = os.path.abspath(extract_dir)
+    tar_parts = []
+    offset = tar_ref.offset
+    for file_info in tar_ref:
+        # offset also counts extended headers and padding of member
+        processed_size = tar_ref.offset - offset
+        offset = tar_ref.offset
+        if file_info.isfile():
+            member_path = get_member_path(extract_dir, file_info.name)
+            if is_extracted_tar_part(abs_extract_dir, member_path):
+                tar_parts.append(member_path)
+            if tar_fd is not None and not file_info.issparse():
+                writer.submit_from_fd(
+                    member_path,
+                    tar_fd,
+                    file_info.offset_data,
+                    file_info.size,
+                    file_info.mode,
+                    processed_size,
+                )
+            elif file_info.size > g.max_buffered_member_size:
+                source = tar_ref.extractfile(file_info)
+                writer.write_stream(member_path, source, file_info.mode, processed_size)
+            else:
+                data = tar_ref.extractfile(file_info).read()
+                writer.submit(member_path, data, file_info.mode, processed_size)
+        else:
+            if file_info.islnk():
+                writer.wait()
+            tar_ref.extract(file_info, path=extract_dir)
+            writer.update_progress(processed_size)
+    return tar_parts
+
+
+def extract_compressed_tar_with_progress(
+    archive_path: str, extract_dir: str, message: str, file_type: str
+) -> List[str]:
+    """
+    Extract compressed tar archive with progress bar
+
+    :param archive_path: path to compressed tar archive
+    :param extract_dir: path to extract directory
+    :param message: message for progress bar
+    :param file_type: type of compression, "gzip", "bzip2", "xz" or "zstd"
+    :return: paths to extracted tar parts
+    """
+
+    with tempfile.TemporaryFile() as stderr_file:
+        stream, process = open_decompressor(archive_path, file_type, stderr_file)
+        try:
+            with tarfile.open(fileobj=stream, mode="r|", bufsize=1 << 20) as tar_ref:
+                with tqdm(is_size=True, desc=message) as progress_bar:
+                    with ParallelFileWriter(progress_bar) as writer:
+                        tar_parts = extract_tar_members(tar_ref, extract_dir, writer)
+            # read padding after end of archive, so decompressor does not fail on closed pipe
+            while stream.read(1 << 20):
+                pass
+        except Exception as e:
+            stream.close()
+            if process is None:
+                raise
+            process.kill()
+            # positive exit code means decompressor failed on its own before it was killed,
+            # its message explains the tar error
+            if process.wait() <= 0:
+                raise
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode("utf-8", errors="replace")
+            raise RuntimeError(f"Failed to decompress archive: {stderr}") from e
+        except BaseException:
+            stream.close()
+            if process is not None:
+                process.kill()
+                process.wait()
+            raise
+        stream.close()
+        if process is not None and process.wait() != 0:
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode("utf-8", errors="replace")
+            raise RuntimeError(f"Failed to decompress archive: {stderr}")
+    return tar_parts
+
+
+def extract_zip_with_progress(archive_path: str, extract_dir: str, message: str) -> List[str]:
+    """
+    Extract zip archive with progress bar.
+    Large archives are extracted by several processes.
 
     :param archive_path: path to zip archive
     :param extract_dir: path to extract directory
     :param message: message for progress bar
+    :return: paths to extracted tar parts
     """
 
+    abs_extract_dir = os.path.abspath(extract_dir)
+    tar_parts = []
+    parallel = (
+        os.path.getsize(archive_path) >= g.zip_parallel_min_size and g.max_process_workers > 1
+    )
     with zipfile.ZipFile(archive_path, "r") as zip_ref:
-        total_size = sum(file_info.file_size for file_info in zip_ref.infolist())
+        file_infos = zip_ref.infolist()
+        total_size = sum(file_info.file_size for file_info in file_infos)
         with tqdm(total=total_size, is_size=True, desc=message) as progress_bar:
-            for file_info in zip_ref.infolist():
-                zip_ref.extract(file_info, extract_dir)
-                progress_bar.update(file_info.file_size)
+            if parallel:
+                members = []
+                directories = set()
+                for file_info in file_infos:
+                    member_path = get_member_path(extract_dir, file_info.filename)
+                    if file_info.is_dir():
+                        directories.add(member_path)
+                        continue
+                    if is_extracted_tar_part(abs_extract_dir, member_path):
+                        tar_parts.append(member_path)
+                    directories.add(os.path.dirname(member_path))
+                    members.append((file_info.filename, member_path))
+                for directory in directories:
+                    os.makedirs(directory, exist_ok=True)
+                extract_zip_in_processes(archive_path, members, progress_bar)
+                return tar_parts
+
+            with ParallelFileWriter(progress_bar) as writer:
+                for file_info in file_infos:
+                    member_path = get_member_path(extract_dir, file_info.filename)
+                    if file_info.is_dir():
+                        writer.make_dirs(member_path)
+                    else:
+                        if is_extracted_tar_part(abs_extract_dir, member_path):
+                            tar_parts.append(member_path)
+                        if file_info.file_size > g.max_buffered_member_size:
+                            with zip_ref.open(file_info) as source:
+                                writer.write_stream(member_path, source)
+                        else:
+                            writer.submit(member_path, zip_ref.read(file_info))
+    return tar_parts
+
+
+def extract_zip_in_processes(
+    archive_path: str, members: List[Tuple[str, str]], progress_bar: tqdm
+) -> None:
+    """
+    Extract members of zip archive by pool of processes, each process reads its own
+    contiguous slice of members. Directories of members must already exist.
+
+    :param archive_path: path to zip archive
+    :param members: names of members and paths to extract them to
+    :param progress_bar: progress bar
+    """
+
+    workers = g.max_process_workers
+    slice_size = max(1, -(-len(members) // (workers * 4)))
+    # fork keeps the already loaded modules and does not re-run globals.py
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        futures = [
+            executor.submit(extract_zip_members, archive_path, members[start : start + slice_size])
+            for start in range(0, len(members), slice_size)
+        ]
+        for future in as_completed(futures):
+            progress_bar.update(future.result())
+
+
+def extract_zip_members(archive_path: str, members: List[Tuple[str, str]]) -> int:
+    """
+    Extract members of zip archive
+
+    :param archive_path: path to zip archive
+    :param members: names of members and paths to extract them to
+    :return: size of extracted data
+    """
+
+    extracted_size = 0
+    with zipfile.ZipFile(archive_path, "r") as zip_ref:
+        for name, member_path in members:
+            with zip_ref.open(name) as source, open(member_path, "wb") as file:
+                # large members are copied in chunks without loading them into memory
+                shutil.copyfileobj(source, file, 1 << 20)
+                extracted_size += file.tell()
+    return extracted_size
 
 
 def check_disk_space(source_path: str, dest_path: str) -> bool:
     """
     Check if there is enough disk space to process archive
 
-    :param source_path: path to directory or file
+    :param source_path: path to archive
+    :param dest_path: path to directory
+    :return: True if there is enough disk space, False otherwise
+    """
+
+    source_size = os.path.getsize(os.path.abspath(source_path))
+    return has_free_space(source_size, dest_path)
+
+
+def has_free_space(required_size: int, dest_path: str) -> bool:
+    """
+    Check if there is enough disk space to write required number of bytes
+
+    :param required_size: required size in bytes
     :param dest_path: path to directory
     :return: True if there is enough disk space, False otherwise
     """
 
-    if os.path.isdir(os.path.abspath(source_path)):
-        source_size = sum(os.path.getsize(f) for f in list_dir_recursively(source_path, True, True))
-    else:
-        source_size = os.path.getsize(os.path.abspath(source_path))
     dest_dir = os.path.dirname(os.path.abspath(dest_path))
     if dest_dir == "":
         dest_dir = "."
     free_space = shutil.disk_usage(dest_dir).free
-    sly.logger.debug(f"Free space: {free_space}, required size: {source_size}")
-    return free_space > source_size
+    sly.logger.debug(f"Free space: {free_space}, required size: {required_size}")
+    return free_space > required_size
 
 
 def unzip_archive(archive_path: str, extract_path: str) -> None:
@@ -274,67 +1269,82 @@ def unzip_archive(archive_path: str, extract_path: str) -> None:
     sly.logger.info(f"{message}, please wait ...")
     try:
         if file_type == "tar":
-            extract_tar_with_progress(archive_path, extract_path, message)
+            tar_parts = extract_tar_with_progress(archive_path, extract_path, message)
         elif file_type == "zip":
-            extract_zip_with_progress(archive_path, extract_path, message)
+            tar_parts = extract_zip_with_progress(archive_path, extract_path, message)
+        else:
+            tar_parts = extract_compressed_tar_with_progress(
+                archive_path, extract_path, message, file_type
+            )
     except Exception as e:
         raise_exception_with_troubleshooting_link(e)
     os.remove(archive_path)
-    tar_parts = get_tar_parts(extract_path)
-    if tar_parts:
-        message = "Extracting combined parts"
-        full_archive = combine_parts(tar_parts, extract_path)
-        extract_tar_with_progress(full_archive, extract_path, message)
-        os.remove(full_archive)
+    extract_tar_parts(tar_parts, extract_path)
 
 
-def get_file_list(temp_files_path: str) -> List[str]:
+def extract_tar_parts(tar_parts: List[str], extract_path: str) -> None:
     """
-    Get list of files in directory
+    Combine and extract parts of tar archive extracted from backup archive
 
-    :param temp_files_path: path to directory
-    :return: list of files
+    :param tar_parts: paths to tar parts
+    :param extract_path: path to extract directory
     """
 
-    filenames = []
-    for filename in os.listdir(temp_files_path):
-        if os.path.isfile(os.path.join(temp_files_path, filename)):
-            filenames.append(filename)
-    return filenames
+    if tar_parts:
+        message = "Extracting combined parts"
+        tar_parts = sorted(set(tar_parts))
+        try:
+            extract_tar_parts_stream(tar_parts, extract_path, message)
+        except tarfile.TarError as e:
+            sly.logger.warning(
+                f"Failed to extract parts of tar archive as a stream: {repr(e)}. "
+                "Combining parts into one archive"
+            )
+            full_archive = combine_parts(tar_parts, extract_path)
+            extract_tar_with_progress(full_archive, extract_path, message)
+            os.remove(full_archive)
+        else:
+            for part_path in tar_parts:
+                os.remove(part_path)
 
 
-def create_reverse_mapping(filenames: str) -> dict:
+def extract_tar_parts_stream(parts_paths: List[str], extract_path: str, message: str) -> None:
     """
-    Create reverse mapping for filenames
+    Extract parts of tar archive as one stream without combining them on disk
 
-    :param filenames: list of filenames
-    :return: reverse mapping
+    :param parts_paths: sorted list of paths to parts
+    :param extract_path: path to extract directory
+    :param message: message for progress bar
     """
 
-    reverse_mapping = {}
-    for filename in filenames:
-        base_name, ext = os.path.splitext(filename)
-        original_name = base_name.replace("-", "/") + ext
-        reverse_mapping[original_name] = filename
-    return reverse_mapping
+    total_size = sum(os.path.getsize(part_path) for part_path in parts_paths)
+    with ConcatenatedFilesReader(parts_paths) as reader:
+        with tarfile.open(fileobj=reader, mode="r|*", bufsize=1 << 20) as tar_ref:
+            with tqdm(total=total_size, is_size=True, desc=message) as progress_bar:
+                with ParallelFileWriter(progress_bar) as writer:
+                    extract_tar_members(tar_ref, extract_path, writer)
 
 
-def make_real_source_path(hash_value: str, temp_files_path: str, reverse_mapping: dict) -> str:
+def create_reverse_mapping(temp_files_path: str) -> dict:
     """
-    Make real source path for file
+    Create reverse mapping from image hashes to names of files in directory
 
-    :param hash_value: hash value
     :param temp_files_path: path to directory
-    :param reverse_mapping: reverse mapping
-    :return: real source path
+    :return: reverse mapping
     """
 
-    if hash_value in reverse_mapping:
-        new_name = reverse_mapping[hash_value]
-        new_path = os.path.join(temp_files_path, new_name)
-    else:
-        return None
-    return new_path
+    reverse_mapping = {}
+    with os.scandir(temp_files_path) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            filename = entry.name
+            dot = filename.rfind(".")
+            if dot <= 0:
+                reverse_mapping[filename.replace("-", "/")] = filename
+            else:
+                reverse_mapping[filename[:dot].replace("-", "/") + filename[dot:]] = filename
+    return reverse_mapping
 
 
 def copy_files_from_json_structure(
@@ -350,70 +1360,145 @@ def copy_files_from_json_structure(
     """
 
     datasets = json_data.get("datasets", [])
+    # files used by a single image are moved, files shared by several images are linked
+    hash_usages = Counter(
+        image["hash"] for dataset in datasets for image in dataset.get("images", [])
+    )
+    futures = []
+    # hashes missed in all datasets are downloaded together
+    missed_hashes = []
+    get_source_name = reverse_mapping.get
+    source_prefix = temp_files_path + os.sep
+    source_device = os.stat(temp_files_path).st_dev
+
+    with ThreadPoolExecutor(max_workers=g.max_io_workers) as executor:
+        submit = executor.submit
+        add_future = futures.append
+        for dataset in datasets:
+            dataset_name = dataset.get("name")
+            images = dataset.get("images", [])
+
+            destination_folder = os.path.join(base_destination, dataset_name, "img")
+            os.makedirs(destination_folder, exist_ok=True)
+            if os.stat(destination_folder).st_dev == source_device:
+                place_single, place_shared = move_or_copy_file, link_or_copy_file
+            else:
+                place_single = place_shared = shutil.copyfile
+
+            destination_prefix = destination_folder + os.sep
+            for image in images:
+                hash_value = image["hash"]
+                name = image["name"]
+                source_name = get_source_name(hash_value)
+                if source_name is None:
+                    missed_hashes.append(
+                        {"hash": hash_value, "path": f"{destination_prefix}{name}"}
+                    )
+                    continue
+                place_file = place_single if hash_usages[hash_value] == 1 else place_shared
+                add_future(
+                    submit(
+                        place_file, f"{source_prefix}{source_name}", f"{destination_prefix}{name}"
+                    )
+                )
 
-    for dataset in datasets:
-        missed_hashes = []
-        dataset_name = dataset.get("name")
-        images = dataset.get("images", [])
+        if len(missed_hashes) != 0:
+            download_missed_hashes(missed_hashes)
 
-        destination_folder = os.path.join(base_destination, dataset_name, "img")
+        for future in as_completed(futures):
+            future.result()
 
-        for image in images:
-            hash_value = image.get("hash")
-            name = image.get("name")
-            real_source_path = make_real_source_path(hash_value, temp_files_path, reverse_mapping)
-            if real_source_path is None:
-                missed_hashes.append({"name": name, "hash": hash_value})
-                continue
-            destination_path = os.path.join(destination_folder, name)
-            shutil.copy(real_source_path, destination_path)
 
-        if len(missed_hashes) != 0:
-            download_missed_hashes(missed_hashes, destination_folder, dataset_name)
+def move_or_copy_file(source_path: str, destination_path: str) -> None:
+    """
+    Move file, copy file if it can not be moved
+
+    :param source_path: path to source file
+    :param destination_path: path to destination file
+    """
+
+    try:
+        os.replace(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
 
 
-def download_missed_hashes(missed_hashes: list, destination_folder: str, dataset_name: str) -> None:
+def link_or_copy_file(source_path: str, destination_path: str) -> None:
     """
-    Download missed hashes
+    Create hard link to file, copy file if link can not be created
 
-    :param missed_hashes: list of missed hashes
-    :param destination_folder: path to destination
-    :param dataset_name: name of dataset
+    :param source_path: path to source file
+    :param destination_path: path to destination file
+    """
+
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
+
+
+def download_missed_hashes(missed_hashes: List[dict], batch_size: int = 500) -> None:
+    """
+    Download missed hashes of all datasets in batches
+
+    :param missed_hashes: list of missed hashes with paths to save images
+    :param batch_size: number of hashes in one request
+    """
+
+    image_hashes = [m_hash["hash"] for m_hash in missed_hashes]
+    image_destination_pathes = [m_hash["path"] for m_hash in missed_hashes]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [
+            executor.submit(
+                download_hashes_batch,
+                image_hashes[start : start + batch_size],
+                image_destination_pathes[start : start + batch_size],
+            )
+            for start in range(0, len(image_hashes), batch_size)
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+
+def download_hashes_batch(image_hashes: List[str], image_destination_pathes: List[str]) -> None:
+    """
+    Download batch of images by hashes, skipping hashes not found on instance
+
+    :param image_hashes: list of hashes
+    :param image_destination_pathes: list of paths to save images
     """
 
-    image_hashes = []
-    image_destination_pathes = []
     errors = 0
-    for m_hash in missed_hashes:
-        name = m_hash["name"]
-        image_destination_path = os.path.join(destination_folder, name)
-        image_hash = m_hash["hash"]
-        image_hashes.append(image_hash)
-        image_destination_pathes.append(image_destination_path)
-    while True:
+    while len(image_hashes) != 0:
         if errors > 4:
-            sly.logger.warning(f"⚠️ Skipping retries for dataset '{dataset_name}'")
+            sly.logger.warning(
+                "⚠️ Skipping retries for missed hashes", extra={"count": len(image_hashes)}
+            )
             break
         try:
             g.api.image.download_paths_by_hashes(image_hashes, image_destination_pathes)
             break
         except requests.HTTPError as e:
             errors += 1
-            content_json = json.loads(e.response.content.decode("utf-8"))
+            try:
+                content_json = json.loads(e.response.content.decode("utf-8"))
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                raise e
             message = content_json.get("details", {}).get("message", [])
             if "Hashes not found" == message:
-                try:
-                    hashes = content_json.get("details", {}).get("hashes", [])
-                except (json.JSONDecodeError, UnicodeDecodeError):
-                    raise e
-                sly.logger.warning(f"Skipping files with this hashes for dataset '{dataset_name}'")
+                hashes = set(content_json.get("details", {}).get("hashes", []))
+                sly.logger.warning(
+                    "Skipping files with this hashes", extra={"count": len(hashes)}
+                )
                 if len(hashes) != 0:
-                    idxs_to_remove = [
-                        index for index, d_hash in enumerate(image_hashes) if d_hash in hashes
+                    kept = [
+                        (d_hash, path)
+                        for d_hash, path in zip(image_hashes, image_destination_pathes)
+                        if d_hash not in hashes
                     ]
-                    for index in sorted(idxs_to_remove, reverse=True):
-                        image_hashes.pop(index)
-                        image_destination_pathes.pop(index)
+                    image_hashes = [d_hash for d_hash, _ in kept]
+                    image_destination_pathes = [path for _, path in kept]
 
 
 def move_files_to_project_dir(temp_files_path: str, proj_path: str) -> None:
@@ -424,15 +1509,16 @@ def move_files_to_project_dir(temp_files_path: str, proj_path: str) -> None:
     :param proj_path: path to project directory
     """
 
-    for item in os.listdir(temp_files_path):
-        item_path = os.path.join(temp_files_path, item)
-        destination_path = os.path.join(proj_path, item)
-
-        if os.path.isdir(item_path):
-            shutil.move(item_path, destination_path)
-        else:
-            shutil.move(item_path, proj_path)
-    shutil.rmtree(temp_files_path)
+    with os.scandir(temp_files_path) as entries:
+        for entry in entries:
+            destination_path = os.path.join(proj_path, entry.name)
+            try:
+                os.rename(entry.path, destination_path)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(entry.path, destination_path)
+    os.rmdir(temp_files_path)
 
 
 def del_files(temp_files_path: str, hash_name_map_path: str) -> None:
@@ -465,18 +1551,98 @@ def import_project_by_type(api: sly.Api, proj_path: str) -> None:
     sly.logger.info("✅ Project successfully restored")
 
 
-def handle_broken_ann(ann_path: str, meta: sly.ProjectMeta, keep_classes: list) -> sly.Annotation:
+def load_json(path: str) -> dict:
+    """
+    Load json file, using orjson if it is installed
+
+    :param path: path to json file
+    :return: json data
+    """
+
+    return load_json_with_fallback_flag(path)[0]
+
+
+def load_json_with_fallback_flag(path: str) -> Tuple[dict, bool]:
+    """
+    Load json file, using orjson if it is installed.
+    Stdlib json is used for files orjson rejects, e.g. with NaN and Infinity values
+
+    :param path: path to json file
+    :return: json data and whether stdlib json was needed to load it
+    """
+
+    if orjson is None:
+        return load_json_file(path), True
+    with open(path, "rb") as file:
+        data = file.read()
+    try:
+        return orjson.loads(data), False
+    except orjson.JSONDecodeError:
+        return json.loads(data), True
+
+
+def dump_json(data: dict, path: str, use_stdlib: bool = False) -> None:
+    """
+    Dump data to json file, using orjson if it is installed
+
+    :param data: json data
+    :param path: path to json file
+    :param use_stdlib: dump with stdlib json, which keeps NaN and Infinity values
+    """
+
+    if orjson is None or use_stdlib:
+        sly.json.dump_json_file(data, path)
+        return
+    try:
+        content = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    except orjson.JSONEncodeError:
+        sly.json.dump_json_file(data, path)
+        return
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+# parsed tags of the project being fixed, keyed by canonical tag json
+tags_cache = {}
+
+
+def tag_from_json(tag_json: dict, tag_metas: sly.TagMetaCollection) -> sly.Tag:
+    """
+    Create tag from json, reusing tags parsed from identical json.
+    Cache must be cleared when project meta changes
+
+    :param tag_json: tag json
+    :param tag_metas: project tag metas
+    :return: tag
+    """
+
+    # orjson writes NaN as null, stdlib json keeps float values distinct
+    if orjson is None or any(isinstance(value, float) for value in tag_json.values()):
+        key = json.dumps(tag_json, sort_keys=True)
+    else:
+        key = orjson.dumps(tag_json, option=orjson.OPT_SORT_KEYS)
+    tag = tags_cache.get(key)
+    if tag is None:
+        tag = sly.Tag.from_json(tag_json, tag_metas)
+        if len(tags_cache) < g.tags_cache_size:
+            tags_cache[key] = tag
+    return tag
+
+
+def handle_broken_ann(
+    ann_path: str, meta: sly.ProjectMeta, keep_classes: FrozenSet[str]
+) -> sly.Annotation:
     """
     Handle broken annotation
 
     :param ann_path: path to annotation
     :param meta: project meta
-    :param keep_classes: list of classes to keep
+    :param keep_classes: names of classes to keep
     :return: annotation
     """
 
     ann_name = os.path.basename(ann_path)
-    ann_json = sly.json.load_json_file(ann_path)
+    ann_json = load_json(ann_path)
     img_size = ann_json.get("size")  # {"height": 800, "width": 1067}
     if img_size is None:
         raise RuntimeError(f"Image size is not found in annotation: {ann_name}")
@@ -487,7 +1653,10 @@ def handle_broken_ann(ann_path: str, meta: sly.ProjectMeta, keep_classes: list)
 
     keep_labels = []
     for obj in objects:
-        obj_class_name = obj.get("classTitle")
+        try:
+            obj_class_name = obj["classTitle"]
+        except KeyError:
+            continue
         if obj_class_name in keep_classes:
             try:
                 label = sly.Label.from_json(obj, meta)
@@ -498,9 +1667,10 @@ def handle_broken_ann(ann_path: str, meta: sly.ProjectMeta, keep_classes: list)
                 )
 
     kepp_tags = []
+    tag_metas = meta.tag_metas
     for tag in tags:
         try:
-            tag = sly.Tag.from_json(tag, meta.tag_metas)
+            tag = tag_from_json(tag, tag_metas)
             kepp_tags.append(tag)
         except Exception as e:
             # * log error level to see what is wrong with annotation tags
@@ -543,29 +1713,64 @@ def check_shapes_in_images_project(project_dir: str) -> None:
                 f"Class will be removed from meta and all annotations."
             )
             remove_classes.append(obj_cls.name)
+    keep_classes = frozenset(keep_classes)
+
+    project_meta = project_fs.meta
+    meta = project_meta.delete_obj_classes(remove_classes)
+    # annotation parsing is CPU-bound, so threads would serialize on the GIL;
+    # fork keeps the already loaded modules and does not re-run globals.py
+    tags_cache.clear()
+    fix_ann = partial(fix_item_ann, meta=project_meta, keep_classes=keep_classes)
+    with ProcessPoolExecutor(
+        max_workers=g.max_process_workers, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        for dataset_fs in project_fs.datasets:
+            dataset_fs: sly.Dataset
+            get_ann_path = dataset_fs.get_ann_path
+            get_img_path = dataset_fs.get_img_path
+            items = [
+                (get_ann_path(item_name), get_img_path(item_name)) for item_name in dataset_fs
+            ]
+            # visit annotations in inode order, which roughly follows on-disk layout
+            with os.scandir(dataset_fs.ann_dir) as entries:
+                inodes = {entry.path: entry.inode() for entry in entries}
+            items.sort(key=lambda item: inodes.get(item[0], 0))
+            for _ in executor.map(fix_ann, items, chunksize=256):
+                pass
+    project_fs.set_meta(meta)
 
-    meta = project_fs.meta.delete_obj_classes(remove_classes)
-    for dataset_fs in project_fs.datasets:
-        dataset_fs: sly.Dataset
-        for item_name in dataset_fs:
-            ann_path = dataset_fs.get_ann_path(item_name)
 
-            try:
-                ann = sly.Annotation.load_json_file(ann_path, project_fs.meta)
-                ann = ann.filter_labels_by_classes(keep_classes)
-            except Exception as e:
-                try:
-                    ann = handle_broken_ann(ann_path, project_fs.meta, keep_classes)
-                except Exception as e:
-                    sly.logger.error(
-                        f"Annotation file is broken. {repr(e)}. Skipping it.",
-                        extra={"ann_path": ann_path},
-                        exc_info=True,
-                    )
-                    item_path = dataset_fs.get_img_path(item_name)
-                    ann = create_empty_ann(item_path)
-            sly.json.dump_json_file(ann.to_json(), ann_path)
-    project_fs.set_meta(meta)
+def fix_item_ann(
+    item: Tuple[str, str],
+    meta: sly.ProjectMeta,
+    keep_classes: FrozenSet[str],
+) -> None:
+    """
+    Remove unsupported labels from item annotation, replace broken annotation
+
+    :param item: paths to item annotation and item file
+    :param meta: project meta
+    :param keep_classes: names of classes to keep
+    """
+
+    ann_path, item_path = item
+    # orjson writes NaN and Infinity as null, keep them if the annotation has any
+    use_stdlib = False
+    try:
+        ann_json, use_stdlib = load_json_with_fallback_flag(ann_path)
+        ann = sly.Annotation.from_json(ann_json, meta)
+        ann = ann.filter_labels_by_classes(keep_classes)
+    except Exception as e:
+        try:
+            ann = handle_broken_ann(ann_path, meta, keep_classes)
+        except Exception as e:
+            sly.logger.error(
+                f"Annotation file is broken. {repr(e)}. Skipping it.",
+                extra={"ann_path": ann_path},
+                exc_info=True,
+            )
+            ann = create_empty_ann(item_path)
+    dump_json(ann.to_json(), ann_path, use_stdlib)
 
 
 def prepare_image_files():
@@ -573,13 +1778,34 @@ def prepare_image_files():
     Prepare image files
     """
 
-    hash_name_map = load_json_file(g.hash_name_map_path)
-    filenames = get_file_list(g.temp_files_path)
-    reverse_map = create_reverse_mapping(filenames)
+    hash_name_map = load_json(g.hash_name_map_path)
+    reverse_map = create_reverse_mapping(g.temp_files_path)
     copy_files_from_json_structure(hash_name_map, g.temp_files_path, reverse_map, g.proj_path)
     del_files(g.temp_files_path, g.hash_name_map_path)
 
 
+def add_to_archive_and_remove(tar: tarfile.TarFile, path: str, arcname: str) -> None:
+    """
+    Add file or directory to tar archive, removing each file right after it is added.
+    Archive is built with the same layout as supervisely.io.fs.archive_directory,
+    but disk usage does not grow to twice the size of the directory.
+
+    :param tar: tar archive opened for writing
+    :param path: path to file or directory
+    :param arcname: name of file or directory in archive
+    """
+
+    tar.add(path, arcname=arcname, recursive=False)
+    if os.path.isdir(path) and not os.path.islink(path):
+        with os.scandir(path) as entries:
+            names = sorted(entry.name for entry in entries)
+        for name in names:
+            add_to_archive_and_remove(tar, os.path.join(path, name), os.path.join(arcname, name))
+        os.rmdir(path)
+    else:
+        os.remove(path)
+
+
 def prepare_downloadable_archive():
     """
     Prepare archive with project in supervisely format and upload it to team files
@@ -587,11 +1813,15 @@ def prepare_downloadable_archive():
 
     tar_path = g.proj_path + ".tar"
 
-    if not check_disk_space(g.proj_path, g.proj_path):
-        raise_exception_with_troubleshooting_link(NotEnoughDiskSpaceError("Not enough disk space"))
-
-    archive_directory(g.proj_path, tar_path)
-    shutil.rmtree(g.proj_path)
+    try:
+        with tarfile.open(tar_path, "w", encoding="utf-8") as tar:
+            add_to_archive_and_remove(tar, g.proj_path, os.path.sep)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise_exception_with_troubleshooting_link(
+                NotEnoughDiskSpaceError("Not enough disk space")
+            )
+        raise
     team_files_path = os.path.join(
         f"/tmp/supervisely/export/restore-archived-project/", str(g.task_id) + "_" + tar_path
     )
@@ -625,11 +1855,15 @@ def main():
     Main function
     """
 
-    download_backup(g.project_info)
-    unzip_archive(g.archive_files_path, g.temp_files_path)
+    files_archive_url = g.project_info.backup_archive.get(ApiField.URL)
+    annotations_archive_url = g.project_info.backup_archive.get(ApiField.ANN_URL)
+
+    restore_backup_archive(files_archive_url, g.archive_files_path, g.temp_files_path, "files")
     if g.project_type == sly.ProjectType.IMAGES.value:
-        if file_exists(g.archive_ann_path):
-            unzip_archive(g.archive_ann_path, g.proj_path)
+        if annotations_archive_url:
+            restore_backup_archive(
+                annotations_archive_url, g.archive_ann_path, g.proj_path, "annotations"
+            )
             prepare_image_files()
         else:
             sly.logger.debug("Attempting to restore images project with an old archive format")